@@ -31,8 +31,6 @@ Notes
 
 """
 
-from typing import Callable
-
 import time
 import board
 import busio
@@ -41,10 +39,35 @@ from digitalio import DigitalInOut, Direction
 from adafruit_bus_device.i2c_device import I2CDevice
 from adafruit_dotstar import DotStar
 
-NUM_KEYS = 16
+try:
+    from micropython import const
+except ImportError:
+    def const(value):
+        return value
+
+# Underscore-prefixed consts are folded into the bytecode by the compiler.
+_NUM_KEYS = const(16)
+_I2C_ADDRESS = const(0x20)
+_ALL_KEYS_MASK = const(0xFFFF)
+
+NUM_KEYS = _NUM_KEYS
 DEFAULT_BRIGHTNESS = 0.05
 ENABLE_SLEEP = True
 
+# The x/y coordinate of each key, from 0,0 to 3,3, indexed by key number.
+_KEY_XY = tuple((n % 4, n // 4) for n in range(_NUM_KEYS))
+
+# An all-off RGB buffer, used to blank the keypad's shadow copy of the LEDs.
+_BLANK_RGB = bytes(3 * _NUM_KEYS)
+
+# Stands in for the handlers of a key that has none attached.
+_NO_HANDLERS = {}
+
+
+def _no_sleep(now):
+    # Stands in for `RGBKeyPad.sleep_handler` when LED sleep is disabled.
+    pass
+
 
 class RGBKeyPad():
     """Represents the keypad and hence a set of Key instances"""
@@ -54,71 +77,141 @@ class RGBKeyPad():
         self.cs = DigitalInOut(board.GP17)
         self.cs.direction = Direction.OUTPUT
         self.cs.value = 0
-        self.pixels = DotStar(board.GP18, board.GP19, 16, brightness=DEFAULT_BRIGHTNESS, auto_write=True)
+        self.pixels = DotStar(board.GP18, board.GP19, _NUM_KEYS, brightness=DEFAULT_BRIGHTNESS, auto_write=False)
         i2c = busio.I2C(board.GP5, board.GP4)
-        self.device = I2CDevice(i2c, 0x20)
+        self.device = I2CDevice(i2c, _I2C_ADDRESS)
+        self._cmd = bytes((0x0,))
+        self._rx = bytearray(2)
     
         # Variables
-        self.states = [0] *16
+        self._states_mask = 0
+        self._mask_prev = 0
+        self._states_cache = None
+        self._pressed_cache = None
+        self._dirty = False
         self.time_of_last_press = time.monotonic()
         self.time_since_last_press = None
-        self.last_led_states = None
+        self._rgb_buf = bytearray(3 * _NUM_KEYS)
+
+        # Handlers for each key's current board state, indexed by key number,
+        # plus every attached handler by key number and then board state.
+        self._press = [None] * _NUM_KEYS
+        self._release = [None] * _NUM_KEYS
+        self._hold = [None] * _NUM_KEYS
+        self._press_by_state = {}
+        self._release_by_state = {}
+        self._hold_by_state = {}
+        self._saved_rgb = None
 
         # Sleep variables
-        self.led_sleep_enabled = True
-        self.led_sleep_time = 1
         self.sleeping = False
         self.was_asleep = False
+        self.led_sleep_enabled = True
+        self.led_sleep_time = 1
 
         # Initialises & attaches the indiviual keys
-        self.keys = [Key(i, self.pixels, self.states[i]) for i in range(NUM_KEYS)]
+        self.keys = [Key(i, self) for i in range(_NUM_KEYS)]
 
     def update(self):
         """Updates the state of the keypad and all of its keys.
         
-        Call this in each iteration of your while loop to update"""
+        Call this in each iteration of your while loop to update. Any LED
+        changes made since the last call are pushed to the LEDs here."""
 
         with self.device:
-            self.device.write(bytes([0x0]))
-            result = bytearray(2)
-            self.device.readinto(result)
-            all_states = result[0] | result[1] << 8
-            for i in range(0,16):
-                if not (1 << i) & all_states:
-                    self.states[i] = 1
-                else:
-                    self.states[i] = 0
-
+            self.device.write_then_readinto(self._cmd, self._rx)
+        all_states = self._rx[0] | self._rx[1] << 8
+        # The expander pulls a pressed key's line low, so invert the
+        # raw bits to get a mask with a 1 for each pressed key.
+        self._states_mask = (~all_states) & _ALL_KEYS_MASK
+
+        # Only rebuild the cached key states once the keys have changed.
+        if self._states_mask != self._mask_prev:
+            self._mask_prev = self._states_mask
+            self._states_cache = None
+            self._pressed_cache = None
+
+        now = time.monotonic()
         for _key in self.keys:
-            _key.update()
+            _key.update(now)
+
+        self._sleep_tick(now)
+
+        if self._dirty:
+            self.pixels.show()
+            self._dirty = False
+
 
-        if ENABLE_SLEEP:
-            self.sleep_handler()
+    @property
+    def led_sleep_enabled(self):
+        """Whether the LEDs turn off after `led_sleep_time` seconds without a press."""
+        return self._led_sleep_enabled
 
+    @led_sleep_enabled.setter
+    def led_sleep_enabled(self, enabled):
+        # Bind the sleep step once here, so update() needn't check the
+        # flags on every poll.
+        self._led_sleep_enabled = enabled
+        if ENABLE_SLEEP and enabled:
+            self._sleep_tick = self.sleep_handler
+            return
+
+        # With LED sleep off but sleep enabled, still keep the press
+        # timing attributes up to date.
+        self._sleep_tick = self._track_last_press if ENABLE_SLEEP else _no_sleep
+        # Nothing will run the wake path from now on, so wake up here.
+        if self.sleeping:
+            self.sleeping = False
+            self._wake()
+
+    def _track_last_press(self, now):
+        # Update `time_of_last_press` and `time_since_last_press` only, for
+        # when LED sleep is disabled.
+        if self._states_mask:
+            self.time_of_last_press = now
+        self.time_since_last_press = now - self.time_of_last_press
 
-    def sleep_handler(self):
-        """Handles the sleep behaviour of the keypad."""
+    def sleep_handler(self, now):
+        """Handles the sleep behaviour of the keypad.
+
+        :param now: the `time.monotonic()` timestamp of the current update"""
         if self.any_pressed():
-            self.time_of_last_press = time.monotonic()
+            self.time_of_last_press = now
             self.sleeping = False
 
-        self.time_since_last_press = time.monotonic() - self.time_of_last_press
+        self.time_since_last_press = now - self.time_of_last_press
 
-        # If LED sleep is enabled, but not engaged, check if enough time
+        # If LED sleep is not engaged, check if enough time
         # has elapsed to engage sleep. If engaged, record the state of the
         # LEDs, so it can be restored on wake.
-        if self.led_sleep_enabled and not self.sleeping:
+        if not self.sleeping:
             if self.time_since_last_press > self.led_sleep_time:
                 self.sleeping = True
-                self.last_led_states = [k.rgb if k.lit else [0, 0, 0] for k in self.keys]
-                self.set_all(0, 0, 0)
+                self._saved_rgb = bytes(self._rgb_buf)
+                self._clear_pixels_fast()
                 self.was_asleep = True
 
         # If it was sleeping, but is no longer, then restore LED states.
         if not self.sleeping and self.was_asleep:
-            for k in range(NUM_KEYS):
-                self.keys[k].set_led(*self.last_led_states[k])
-            self.was_asleep = False
+            self._wake()
+
+    def _wake(self):
+        # Restore the LED states saved when sleep was engaged. The snapshot
+        # is written straight into the pixels and the RGB buffer, rather
+        # than going through each key's `set_led`.
+        saved = self._saved_rgb
+        self._rgb_buf[:] = saved
+        pixels = self.pixels
+        for _key in self.keys:
+            n = _key.number
+            i = 3 * n
+            rgb = (saved[i], saved[i + 1], saved[i + 2])
+            pixels[n] = rgb
+            _key.lit = bool(saved[i] or saved[i + 1] or saved[i + 2])
+            if _key.lit:
+                _key.rgb = rgb
+        self._dirty = True
+        self.was_asleep = False
 
     def set_led(self, number, r, g, b):
         """Set an individual key's LED to an RGB value by its number."""
@@ -132,41 +225,61 @@ class RGBKeyPad():
             for _key in self.keys:
                 _key.set_led(r, g, b)
         else:
-            for _key in self.keys:
-                _key.led_off()
+            self._clear_pixels_fast()
 
     def clear_all(self):
         """Turns off all of the keypad's LEDs"""
+        self._clear_pixels_fast()
+
+    def _clear_pixels_fast(self):
+        # Blank the whole strip with a single fill, then mark each key as
+        # unlit without writing its pixel again.
+        self.pixels.fill((0, 0, 0))
+        self._rgb_buf[:] = _BLANK_RGB
         for _key in self.keys:
-            _key.led_off()
+            _key._mark_off()
+        self._dirty = True
 
-    def get_states(self) -> list[bool]:
+    def get_states(self) -> tuple[int, ...]:
         """Get the states of all the keys on the keypad.
         
-        Returns a list of the key states (0=not pressed, 1=pressed)"""
-        _states = [_key.key_state for _key in self.keys]
-        return _states
+        Returns a tuple of the key states (0=not pressed, 1=pressed)"""
+        if self._states_cache is None:
+            _mask = self._states_mask
+            self._states_cache = tuple((_mask >> i) & 1 for i in range(_NUM_KEYS))
+        return self._states_cache
 
-    def get_pressed(self)-> list[int]:
-        """Returns a list of key numbers currently pressed"""
+    def get_pressed(self)-> tuple[int, ...]:
+        """Returns a tuple of key numbers currently pressed"""
 
-        _pressed = [_key.number for _key in self.keys if _key.key_state]
-        return _pressed
+        if self._pressed_cache is None:
+            _mask = self._states_mask
+            self._pressed_cache = tuple(i for i in range(_NUM_KEYS) if (_mask >> i) & 1)
+        return self._pressed_cache
 
     def any_pressed(self) -> bool:
         """Returns True if any key is pressed, False if none are pressed."""
 
-        return any(self.get_states())
+        return self._states_mask != 0
 
     def none_pressed(self):
         """Returns True if none of the keys are pressed, False is any key is pressed."""
-        return not any(self.get_states())
+        return self._states_mask == 0
+
+    @staticmethod
+    def _attach(active, by_state, _key, state, handler):
+        # Record a handler for a key and board state, and make it the active
+        # handler if the key is currently in that state.
+        by_state.setdefault(_key.number, {})[state] = handler
+        if state == _key.board_state:
+            active[_key.number] = handler
+            _key._refresh_has_handlers()
 
     @staticmethod
     def on_press(_key, state:str = 'default', handler=None):
         """Attaches a press function to a key, via a decorator.
         
-        This is stored as `key.press_function` in the key's attributes, and runs if triggered.
+        This is stored on the key's keypad, indexed by key number, and runs if triggered.
         
         It can be attached as follows:
 
@@ -181,7 +294,8 @@ class RGBKeyPad():
             return
 
         def attach_handler(a_handler):
-            _key.press_functions[state] = a_handler
+            keypad = _key.keypad
+            keypad._attach(keypad._press, keypad._press_by_state, _key, state, a_handler)
 
         if handler is not None:
             attach_handler(handler)
@@ -192,7 +306,7 @@ class RGBKeyPad():
     def on_release(_key, state:str = 'default', handler=None):
         """Attaches a release function to a key, via a decorator.
         
-        This is stored as `key.release_function` in the key's attributes, and runs if triggered.
+        This is stored on the key's keypad, indexed by key number, and runs if triggered.
 
         @RGBKeyPad.on_release(key, state='state_name')
         def release_handler(key):
@@ -203,7 +317,8 @@ class RGBKeyPad():
             return
 
         def attach_handler(a_handler):
-            _key.release_functions[state] = a_handler
+            keypad = _key.keypad
+            keypad._attach(keypad._release, keypad._release_by_state, _key, state, a_handler)
 
         if handler is not None:
             attach_handler(handler)
@@ -214,7 +329,7 @@ class RGBKeyPad():
     def on_hold(_key, state:str = 'default', handler=None):
         """Attaches a hold function to a key, via a decorator.
         
-        This is stored as `key.hold_function` in the key's attributes, and runs if triggered.
+        This is stored on the key's keypad, indexed by key number, and runs if triggered.
 
         @RGBKeyPad.on_release(key, state='state_name') 
         def hold_handler(key):
@@ -225,7 +340,8 @@ class RGBKeyPad():
             return
 
         def attach_handler(a_handler):
-            _key.hold_functions[state] = a_handler
+            keypad = _key.keypad
+            keypad._attach(keypad._hold, keypad._hold_by_state, _key, state, a_handler)
 
         if handler is not None:
             attach_handler(handler)
@@ -237,105 +353,149 @@ class Key:
     """Represents a key on Keypad.
 
     :param number: the unique key number (0-15) to associate with the key
-    :param pixels: the dotstar instance for the LEDs
-    :param current_state: the current state of the key (0 or 1)
+    :param keypad: the RGBKeyPad instance the key belongs to
     :param board_state: the state of the board (default or other)
     """
-    def __init__(self, number: int, pixels: DotStar, key_state: bool, board_state: str = 'default'):
+    __slots__ = ('number', 'keypad', 'pixels', 'current_state', '_board_state',
+                 'key_state', 'pressed', 'last_state', 'time_of_last_press',
+                 'time_since_last_press', 'time_held_for', 'held', 'hold_time',
+                 'modifier', 'rgb', 'lit', 'x', 'y', 'press_func_fired',
+                 'hold_func_fired', 'debounce', 'key_locked', '_has_press',
+                 '_has_release', '_has_hold', '_transitions')
+
+    def __init__(self, number: int, keypad: 'RGBKeyPad', board_state: str = 'default'):
         self.number = number
-        self.pixels = pixels
-        self.current_state = key_state
-        self.board_state = board_state
+        self.keypad = keypad
+        self.pixels = keypad.pixels
+        self.current_state = 0
         self.key_state = 0
         self.pressed = 0
-        self.last_state = None
+        self.last_state = False
         self.time_of_last_press = time.monotonic()
         self.time_since_last_press = None
         self.time_held_for = 0
         self.held = False
         self.hold_time = 0.75
         self.modifier = False
-        self.rgb = [0, 0, 0]
+        self.rgb = (0, 0, 0)
         self.lit = False
-        self.xy = self.get_xy()
-        self.x, self.y = self.xy
+        self.x, self.y = _KEY_XY[number]
         self.led_off()
-        self.press_functions: dict[str, Callable] = {'default': None}
-        self.release_functions: dict[str, Callable]= {'default': None}
-        self.hold_functions:dict[str, Callable] = {'default': None}
         self.press_func_fired = False
         self.hold_func_fired = False
         self.debounce = 0.125
         self.key_locked = False
+        self.board_state = board_state
+        # Indexed by (last_state << 1) | pressed.
+        self._transitions = (self._on_idle, self._on_edge_press,
+                             self._on_edge_release, self._on_hold_tick)
 
+    def update(self, now):
+        """Updates the state of the key and all of its attributes.
 
-    def update(self):
-        """Updates the state of the key and all of its attributes."""
+        :param now: the `time.monotonic()` timestamp of the current update"""
 
-        self.time_since_last_press = time.monotonic() - self.time_of_last_press
+        # Only write attributes that have changed, so an idle key costs
+        # as few stores as possible.
+        state = (self.keypad._states_mask >> self.number) & 1
+        if state != self.key_state:
+            self.current_state = self.key_state = self.pressed = state
+        self.time_since_last_press = now - self.time_of_last_press
 
         # Keys get locked during the debounce time. This is to prevent rapid key presses.
         if self.time_since_last_press < self.debounce:
-            self.key_locked = True
-        else:
+            if not self.key_locked:
+                self.key_locked = True
+        elif self.key_locked:
             self.key_locked = False
 
-        self.key_state = self.current_state
-        self.pressed = self.key_state
-        update_time = time.monotonic()
-
         # If there's a `press_function` attached, then call it,
         # returning the key object and the pressed state.
-        if self.press_functions is not None and self.pressed and not self.press_func_fired and not self.key_locked:
-            self.press_functions[self.board_state](self)
+        if self._has_press and self.pressed and not self.press_func_fired and not self.key_locked:
+            self.keypad._press[self.number](self)
             self.press_func_fired = True
             # time.sleep(0.05)  # A little debounce
 
-        # If the key has been pressed and releases, then call
-        # the `release_function`, if one is attached.
-        if not self.pressed and self.last_state:
-            if self.release_functions is not None:
-                self.release_functions[self.board_state](self)
-            self.last_state = False
-            self.press_func_fired = False
-
-        if not self.pressed:
-            self.time_held_for = 0
-            self.last_state = False
-
-        # If the key has just been pressed, then record the
-        # `time_of_last_press`, and update last_state.
-        elif self.pressed and not self.last_state:
-            self.time_of_last_press = update_time
-            self.last_state = True
-
-        # If the key is pressed and held, then update the
-        # `time_held_for` variable.
-        elif self.pressed and self.last_state:
-            self.time_held_for = update_time - self.time_of_last_press
-            self.last_state = True
+        # Step the key from its last state to its current one.
+        self._transitions[(self.last_state << 1) | self.pressed](now)
 
         # If the `hold_time` threshold is crossed, then call the
         # `hold_function` if one is attached. The `hold_func_fired`
         # ensures that the function is only called once.
         if self.time_held_for > self.hold_time:
-            self.held = True
-            if self.hold_functions is not None and not self.hold_func_fired:
-                self.hold_functions[self.board_state](self)
+            if not self.hold_func_fired:
+                self.held = True
+                if self._has_hold:
+                    self.keypad._hold[self.number](self)
                 self.hold_func_fired = True
-        else:
+        elif self.held:
             self.held = False
             self.hold_func_fired = False
 
-    def get_xy(self):
-        # Returns the x/y coordinate of a key from 0,0 to 3,3.
+    def _on_idle(self, now):
+        # The key is not pressed, and wasn't last time either. Nothing to do,
+        # as `time_held_for` was already reset on release.
+
+        pass
+
+    def _on_edge_press(self, now):
+        # The key has just been pressed, so record the `time_of_last_press`.
+
+        self.time_of_last_press = now
+        self.last_state = True
+
+    def _on_edge_release(self, now):
+        # The key has been pressed and released, so call the
+        # `release_function`, if one is attached.
+
+        if self._has_release:
+            self.keypad._release[self.number](self)
+        self.last_state = False
+        self.press_func_fired = False
+        self.time_held_for = 0
+
+    def _on_hold_tick(self, now):
+        # The key is pressed and held, so update `time_held_for`.
+
+        self.time_held_for = now - self.time_of_last_press
+
+    @property
+    def board_state(self):
+        """The state of the board, which selects the key's press, release and hold functions."""
+        return self._board_state
+
+    @board_state.setter
+    def board_state(self, state):
+        # Switching state makes the press, release and hold functions
+        # attached for that state the active ones.
+        self._board_state = state
+        keypad = self.keypad
+        n = self.number
+        keypad._press[n] = keypad._press_by_state.get(n, _NO_HANDLERS).get(state)
+        keypad._release[n] = keypad._release_by_state.get(n, _NO_HANDLERS).get(state)
+        keypad._hold[n] = keypad._hold_by_state.get(n, _NO_HANDLERS).get(state)
+        self._refresh_has_handlers()
+
+    def set_board_state(self, state):
+        # Switch the key to another board state, the same as assigning
+        # `board_state`.
+
+        self.board_state = state
+
+    def _refresh_has_handlers(self):
+        # Note which kinds of handler the key has for its current state, so
+        # update() can skip the work for the others.
 
-        return number_to_xy(self.number)
+        keypad = self.keypad
+        n = self.number
+        self._has_press = keypad._press[n] is not None
+        self._has_release = keypad._release[n] is not None
+        self._has_hold = keypad._hold[n] is not None
 
     def get_number(self):
         # Returns the key number, from 0 to 15.
 
-        return xy_to_number(self.x, self.y)
+        return self.number
 
     def is_modifier(self):
         # Designates a modifier key, so you can hold the modifier
@@ -349,24 +509,39 @@ class Key:
     def set_led(self, r, g, b):
         # Set this key's LED to an RGB value.
 
-        if [r, g, b] == [0, 0, 0]:
-            self.lit = False
-        else:
-            self.lit = True
-            self.rgb = [r, g, b]
-
-        self.pixels[self.number] = (r, g, b)
+        if r or g or b:
+            self.rgb = (r, g, b)
+        self._write_pixel(r, g, b)
 
     def led_on(self):
         # Turn the LED on, using its current RGB value.
 
         r, g, b = self.rgb
-        self.set_led(r, g, b)
+        self._write_pixel(r, g, b)
 
     def led_off(self):
-        # Turn the LED off.
+        # Turn the LED off, keeping `rgb` for when it's turned back on.
+
+        self._write_pixel(0, 0, 0)
+
+    def _write_pixel(self, r, g, b):
+        # Write an RGB value to this key's pixel and mirror it into the
+        # keypad's flat RGB buffer, so that sleep can snapshot every LED
+        # with a single copy. The LEDs update at the next keypad update().
+
+        self.lit = bool(r or g or b)
+        self.pixels[self.number] = (r, g, b)
+        buf = self.keypad._rgb_buf
+        i = 3 * self.number
+        buf[i] = r
+        buf[i + 1] = g
+        buf[i + 2] = b
+        self.keypad._dirty = True
+
+    def _mark_off(self):
+        # Record the LED as off, for when the pixel has already been cleared.
 
-        self.set_led(0, 0, 0)
+        self.lit = False
 
     def led_state(self, state):
         # Set the LED's state (0=off, 1=on)
@@ -386,7 +561,7 @@ class Key:
         # the toggle.
 
         if rgb is not None:
-            self.rgb = rgb
+            self.rgb = tuple(rgb)
         if self.lit:
             self.led_off()
         else:
@@ -409,29 +584,35 @@ def number_to_xy(number):
     return x, y
 
 
+def _build_hue_lut():
+    # Build the RGB (0-255) colour of each hue (0-255) at full saturation
+    # and value, flattened as r, g, b triples.
+    lut = bytearray(3 * 256)
+    for h in range(256):
+        i, f = divmod(h * 6, 256)
+        rgb = ((255, f, 0), (255 - f, 255, 0), (0, 255, f),
+               (0, 255 - f, 255), (f, 0, 255), (255, 0, 255 - f))[i]
+        lut[3 * h:3 * h + 3] = bytes(rgb)
+    return bytes(lut)
+
+
+_HUE_LUT = _build_hue_lut()
+
+
+def _hsv_to_rgb_int(h, s, v):
+    # Convert an HSV (0-255) colour to RGB (0-255) by looking up the hue and
+    # then scaling it towards white by saturation and towards black by value.
+    i = 3 * h
+    r, g, b = _HUE_LUT[i], _HUE_LUT[i + 1], _HUE_LUT[i + 2]
+    s = 256 - s
+    v = v + 1
+    r = ((r + (((255 - r) * s) >> 8)) * v) >> 8
+    g = ((g + (((255 - g) * s) >> 8)) * v) >> 8
+    b = ((b + (((255 - b) * s) >> 8)) * v) >> 8
+
+    return r, g, b
+
+
 def hsv_to_rgb(h, s, v):
     # Convert an HSV (0.0-1.0) colour to RGB (0-255)
-    rgb = [v, v, v]  # s = 0, default value
-
-    i = int(h * 6.0)
-
-    f = (h * 6.) - i
-    p, q, t = v * (1. - s), v * (1. - s * f), v * (1. - s * (1. - f))
-    i %= 6
-
-    if i == 0:
-        rgb = [v, t, p]
-    if i == 1:
-        rgb = [q, v, p]
-    if i == 2:
-        rgb = [p, v, t]
-    if i == 3:
-        rgb = [p, q, v]
-    if i == 4:
-        rgb = [t, p, v]
-    if i == 5:
-        rgb = [v, p, q]
-
-    rgb = tuple(int(c * 255) for c in rgb)
-
-    return rgb   
\ No newline at end of file
+    return _hsv_to_rgb_int(int(h * 256) & 0xff, int(s * 255), int(v * 255))